@@ -3,16 +3,17 @@
 '''
 This module contains tools for reading and handling Supermag data files.
 
-Dependencies: Numpy, Scipy, and Matplotlib.
+Dependencies: Numpy.
 
 TO-DO:
 --Add test suite
 --Add example code
 '''
 
+import os
 import re
-import datetime as dt
 import warnings
+import functools
 import numpy as np
 
 # Set install directory:
@@ -25,6 +26,14 @@ install_dir = '/'.join(__loader__.path.split('/')[:-1])+'/'
 varmap = {2:1, 5:-6, 6:-6}
 varmap['unrecognized'] = varmap[max(varmap.keys())]
 
+# Pattern for parsing variable names and units, e.g. "<SML (nT)>", from
+# index file headers.  Compiled once for all files.
+_varname_re = re.compile(r'<(.+?)\s*(\(\w+\))?>')
+
+# Pattern marking the end of a SuperMag data file header: the separator
+# line (older revisions) or parameter list (newer revisions).
+_headend_re = re.compile('==|Parameters')
+
 def _convert_entry(value):
     '''
     Helper function for reading and loading station info file.
@@ -36,7 +45,28 @@ def _convert_entry(value):
         return value.strip('"')
     else:
         return float(value)
+
+def _build_times(ymdhms):
+    '''
+    Helper function for converting an N-by-6 array of integer year, month,
+    day, hour, minute, and second values into an array of numpy
+    datetime64 values (second precision) in a single vectorized pass.
+    '''
+
+    ymdhms = np.asarray(ymdhms, dtype=int)
+
+    # Build dates from years and months since epoch, then add days:
+    time = (ymdhms[:,0]-1970).astype('datetime64[Y]') + \
+           (ymdhms[:,1]-1).astype('timedelta64[M]')
+    time = time.astype('datetime64[D]') + \
+           (ymdhms[:,2]-1).astype('timedelta64[D]')
+
+    # Add hours, minutes, and seconds:
+    secs = 3600*ymdhms[:,3] + 60*ymdhms[:,4] + ymdhms[:,5]
+
+    return time.astype('datetime64[s]') + secs.astype('timedelta64[s]')
     
+@functools.lru_cache(maxsize=4)
 def read_statinfo(filename='default'):
     '''
     Open and parse an "ascii" formatted file of station information as provided
@@ -45,6 +75,10 @@ def read_statinfo(filename='default'):
 
     *filename* sets the location of the information file.  Default behavior
     is to use the file contained with the package.
+
+    Results are cached by filename, so repeated calls (e.g., one per
+    `SuperMag` object) only parse the file once.  The returned dictionary
+    is shared between callers and should not be modified in place.
     '''
 
     # Set file name path:
@@ -72,16 +106,15 @@ def read_statinfo(filename='default'):
 
     # Read rest of data:
     for l in lines:
-        # Split on tabs:
-        parts = l.split('\t')
-        # Some lines have double-tabs which give blank entries in parts:
-        while '' in parts: parts.remove('')
+        # Split on tabs, dropping the line ending.  Some lines have
+        # double-tabs which give blank entries; filter those out in
+        # the same pass:
+        parts = [p for p in l.rstrip('\r\n').split('\t') if p]
 
         # Create new entry within main data structure for
         # each station:
-        data[parts[0]] = {}
-        for key, value in zip( header[1:], parts[1:] ):
-            data[parts[0]][key] = _convert_entry(value)
+        data[parts[0]] = {key: _convert_entry(value)
+                          for key, value in zip(header[1:], parts[1:])}
 
     return data
 
@@ -128,26 +161,31 @@ class IndexFile(dict):
 
         # Open, read, and close file:
         with open(self.filename, 'r') as f:
-            # Skip bulk of header.
-            while '==' not in f.readline(): continue
-            head  = f.readline()  # Read varnames & units
-            lines = f.readlines() # Slurp rest of data.
+            raw = f.read()
+
+        # Skip bulk of header by jumping past the '==' separator line,
+        # then split off varnames & units from the rest of the data.
+        iSep = raw.find('==')
+        if iSep < 0:
+            raise ValueError("No '==' header separator found in index "
+                             "file {}".format(self.filename))
+        iEnd = raw.find('\n', iSep)+1
+        head, _, data = raw[iEnd:].partition('\n')
+        lines = data.splitlines()
 
         # Parse variable names besides time:
-        varnames = [x[0] for x in re.findall('\<(.+?)\s*(\(\w+\))?\>',head)[6:]]
-
-        # Build containers:
-        nLines = len(lines)
-        self['time'] = np.zeros(nLines, dtype=object)
-        for v in varnames: self[v] = np.zeros(nLines)
-
-        # Parse data and fill container:
-        for i,l in enumerate(lines):
-            parts = l.split()
-            self['time'][i] = dt.datetime.strptime(
-                ' '.join(parts[:6]), '%Y %m %d %H %M %S')
-            for v, x in zip(varnames,parts[6:]):
-                self[v][i] = x
+        varnames = [x[0] for x in _varname_re.findall(head)[6:]]
+
+        # Parse all data in bulk.  Files may have a header but no records.
+        if lines:
+            values = np.loadtxt(lines, ndmin=2)
+        else:
+            values = np.zeros([0, 6+len(varnames)])
+
+        # Convert all times at once; fill container with columns:
+        self['time'] = _build_times(values[:,:6])
+        for i, v in enumerate(varnames):
+            self[v] = values[:,6+i]
             
 class SuperMag(dict):
     '''
@@ -158,8 +196,11 @@ class SuperMag(dict):
 
     Parameters
     ==========
-    filename : string
+    filename : string or file-like
         The name of the SuperMag file to read and load into the data structure.
+        Alternatively, an open file or buffer with a `read` method (e.g., an
+        `mmap.mmap` of the file) that returns the file contents as text
+        or bytes.
 
     Other Parameters
     ================
@@ -167,6 +208,12 @@ class SuperMag(dict):
         Load the station info (name, lat, lon, etc.) from a separate file.
         If station info is loaded, each station's local time is saved as
         `self['station']['lt']`.
+    cache : bool
+        Save the parsed file as a numpy ".npz" file next to the original
+        (i.e., `filename + '.npz'`) and load from it on later reads,
+        skipping the ASCII parse.  The cache is ignored if it is older
+        than the original file.  Requires *filename* to be a file name.
+        Defaults to False.
 
     Example
     =======
@@ -181,11 +228,10 @@ class SuperMag(dict):
 
     TO-DO:
     --Allow user to select how to handle bad data: mask data or interpolate.
-    --Make calculations of deltaB, H-components optional.
-    --Move calculations (calc_H, etc.) to object methods.    
     '''
 
-    def __init__(self, filename, load_info=True, *args, **kwargs):
+    def __init__(self, filename, load_info=True, cache=False,
+                 *args, **kwargs):
         '''
         Instantiate object, read file, populate object.
         '''
@@ -196,15 +242,23 @@ class SuperMag(dict):
         # Store filename within object:
         self.filename = filename
 
-        # Read data file:
-        self._read_supermag()
+        # Read data file, using an up-to-date cache if requested:
+        if cache and hasattr(filename, 'read'):
+            raise ValueError('Caching requires a file name, not a file object.')
+        cachefile = str(filename) + '.npz'
+        if cache and os.path.exists(cachefile) and \
+           os.path.getmtime(cachefile) >= os.path.getmtime(filename):
+            self._read_cache(cachefile)
+        else:
+            self._read_supermag()
+            if cache: self._save_cache(cachefile)
 
         # Add station info to each station if required.
         # Calculate local time for each station:
         if load_info:
             # Calculate hours to use for local time determination.
-            hours = np.array(
-                [x.hour+x.minute/60.+x.second/3600 for x in self['time']])
+            secs  = self['time'].astype('datetime64[s]').astype(np.int64)
+            hours = (secs % 86400) / 3600.
             
             info = read_statinfo()
             for s in self:
@@ -213,8 +267,7 @@ class SuperMag(dict):
                     self[s]['geolat'] = info[s]['geolat']
                     self[s]['name']   = info[s]['station-name']
                     # Calculate local time, do not let it go over 24 hours.
-                    self[s]['lt'] = hours+info[s]['geolon']*24/360
-                    self[s]['lt'][self[s]['lt']>=24]-=24
+                    self[s]['lt'] = np.mod(hours+info[s]['geolon']/15., 24.)
                     
     def _read_supermag(self):
         '''
@@ -222,34 +275,47 @@ class SuperMag(dict):
         and numpy arrays of magetometer delta-Bs for each mag in the file.
         '''
 
-        from matplotlib.dates import date2num
-        from scipy.interpolate import interp1d
-    
-        f = open(self.filename, 'r')
-
-        # Set default revision:
+        # Slurp the whole file at once; accept open files and buffers, too.
+        if hasattr(self.filename, 'read'):
+            raw = self.filename.read()
+        else:
+            with open(self.filename, 'r') as f:
+                raw = f.read()
+        if isinstance(raw, bytes): raw = raw.decode()
+
+        # Split header from data.  Rather than looping line by line, find
+        # where the file lists stations and the first end-of-header marker
+        # that follows with single scans over the text.
+        fname = getattr(self.filename, 'name', self.filename)
+        iSel  = raw.find('Selected')
+        if iSel < 0:
+            raise ValueError("No station selection ('Selected') found in "
+                             "header of {}".format(fname))
+        match = _headend_re.search(raw, iSel)
+        if match is None:
+            raise ValueError("No end of header ('==' or 'Parameters') found "
+                             "after station selection in {}".format(fname))
+        iEnd = match.end()
+        iEnd = raw.find('\n', iEnd)+1 or len(raw)
+        header = raw[:iEnd].splitlines()
+        lines  = raw[iEnd:].splitlines()
+
+        # Find format version from the header; set default revision first.
+        iLine = raw.count('\n', 0, iSel)
         self.vers = 'unrecognized'
-        
-        # Skip header: jump to point where file lists stations.
-        # Find format version, too.
-        line = f.readline() # Read first line.
-        nSkip = 1
-        while 'Selected' not in line:
-            nSkip+=1
+        for line in header[:iLine]:
             if 'Revision' in line:
                 self.vers = int(line.split(':')[-1])
-            line = f.readline()
+
+        # Grab line with station list in it:
+        line = header[iLine]
+        head = line if 'Stations' in line else header[iLine+1]
 
         # Warn if unrecognized revision:
-        if self.vers == 'unrecognized':
-            warnings.warn("Unrecognized file format revision.  "+
-                          "Check validity of file read.")
-            
+        self._check_vers()
+
         # From the revision, get the index offset to read variables:
         iOff = varmap[self.vers]
-            
-        # Grab line with station list in it:
-        head = line if 'Stations' in line else f.readline()
 
         # Parse station list:
         stats  = head.split()[-1].split(',')
@@ -258,126 +324,198 @@ class SuperMag(dict):
         # Save this information within object:
         self.stations = stats
         self.nstats   = nStats
-
-        # Skip remainder of header; count skipped lines:
-        while '==' not in line and 'Parameters' not in line:
-            line = f.readline()
-            nSkip+=1
-
-        
-        # Now, slurp rest of lines and count number of records.
-        lines = f.readlines()
-        f.close()
         
         # Get number of lines.  The issue is that the number
         # of lines does not scale directly with number of stations.
         # Bad data entries may be omitted, leading to irregular
-        # file sizes.  As such, we need to search the hard way.
-        nTime = 0
-        for l in lines:
-            nTime += 1*bool(re.match('^\d{4}\s+\d{2}\s+\d{2}\s+', l))
-
-        # Create container arrays for all data:
-        self['time'] = np.zeros(nTime, dtype=object)
-        for s in stats: # Initialize with Bad Data Flag
-            self[s] = {}  # Start with empty dictionary
-            for x in ['bx','by','bz','bx_geo', 'by_geo','bz_geo']:
-                self[s][x] = np.zeros( [nTime] )+999999.
-
-        # Re-open file, skip header, and work line by line.
-        f = open(self.filename, 'r')
-        for i in range(nSkip+1*(self.vers==2)):
-            f.readline()
-
-        # Read data by looping over "records": chunks of text that start
-        # with the current time and go until all stations with data for that
-        # epoch have been listed.  Not all stations will have entries for
+        # file sizes.  As such, we need to search the hard way:
+        # flag lines that start a record (timestamps) and lines that
+        # hold station values.
+        lines  = np.array(lines, dtype=object)
+
+        # Record headers are the only lines that start with a 4-digit year.
+        isTime = np.array([l[:4].isdigit() for l in lines], dtype=bool)
+        statset = frozenset(stats)
+        isStat = np.array([l[:3] in statset for l in lines], dtype=bool)
+        isStat &= ~isTime
+        nTime  = isTime.sum()
+
+        # Each station line belongs to the record started by the most
+        # recent timestamp line.  Not all stations will have entries for
         # each record, so we need to account for that.
-        line = f.readline()
-        for j in range(nTime):
-            # Get time:
-            self['time'][j] = dt.datetime.strptime(
-                ''.join(line.split()[:6]), '%Y%m%d%H%M%S')
+        iRec = (np.cumsum(isTime)-1)[isStat]
+
+        # Tokenize all record times and station values in bulk.
+        # Files may have a header but no records.
+        if nTime:
+            rawtime = np.loadtxt(lines[isTime], usecols=range(6),
+                                 dtype=int, ndmin=2)
+        else:
+            rawtime = np.zeros([0, 6], dtype=int)
+        statlines = lines[isStat]
+        if statlines.size:
+            iCol = iOff % len(statlines[0].split())
+            vals = np.loadtxt(statlines, usecols=range(iCol, iCol+6),
+                              ndmin=2)
+        else:
+            vals = np.zeros([0, 6])
+
+        # Map station codes to integer indices into the station list
+        # with a sorted search, avoiding per-line string handling:
+        codes = statlines.astype('U3')
+        order = np.argsort(stats)
+        iStat = order[np.searchsorted(np.array(stats)[order], codes)]
+
+        # Create a single container array for all data, initialized with
+        # the bad data flag, and fill with values where each station has
+        # them.  Dimensions are station, variable, and time.
+        self._buf = np.full([nStats, 6, nTime], 999999.)
+        self._buf[iStat, :, iRec] = vals
+
+        # Convert all record times at once (set first so that 'time' is
+        # the first key, ahead of the stations):
+        self['time'] = _build_times(rawtime)
+
+        # Expose each station as a dictionary of views into the container:
+        self._set_stations()
         
-            # Get values.  Loop through lines until we are on a line
-            # without a station name. 
-            line = f.readline()
-            while line[:3] in stats:
-                parts = line.split()
-                self[parts[0]]['bx'][j] = parts[iOff  ]
-                self[parts[0]]['by'][j] = parts[iOff+1]
-                self[parts[0]]['bz'][j] = parts[iOff+2]
-                self[parts[0]]['bx_geo'][j] = parts[iOff+3]
-                self[parts[0]]['by_geo'][j] = parts[iOff+4]
-                self[parts[0]]['bz_geo'][j] = parts[iOff+5]
-                line = f.readline()
-
-        # close our file.
-        f.close()
-        
-        # Filter bad data.
-        t = date2num(self['time'])
-        for s in stats:
-            for x in ['bx','by','bz']:
-                self[s][x][self[s][x]>=999999.] = np.nan
+        # Filter bad data from the field components of all stations at once.
+        bfield = self._buf[:, :3]
+        np.putmask(bfield, bfield>=999999., np.nan)
 
         # Interpolate over bad data: COMMENTED OUT FOR TIME BEING.
-        #for idir in range(3):
-        #    bad = np.isnan(self[s][idir,:])
-        #    good= np.logical_not(bad)
-        #    self[s][idir,bad] = interp1d(t[good], self[s][idir,good],
-        #                                 fill_value='extrapolate')(t[bad])
+        # Note that np.interp holds edge values rather than extrapolating.
+        #t = self['time'].astype('float64') # Seconds since epoch.
+        #for s in stats:
+        #    for x in ['bx','by','bz']:
+        #        bad = np.isnan(self[s][x])
+        #        good= np.logical_not(bad)
+        #        self[s][x][bad] = np.interp(t[bad], t[good], self[s][x][good])
             
-        # Get time in seconds:
-        dtime = np.array([x.total_seconds() for x in np.diff(self['time'])])
-    
-        # Calc H component (following Pulkkinen et al 2013, NON STANDARD!!!)
-        # OFF BY DEFAULT
-        calc_H=False
-        calc_dbdt=False 
-        if calc_H:
-            for s in stats:
-                # Horizontal field magnitude:
-                self[s+'_H'] = np.sqrt(self[s][0,:]**2 + self[s][1,:]**2)
-
-        # Calculate time derivatives if required:
-        if calc_dbdt:
-            for s in stats:
-                # Get dB_n/dt and dB_e/dt:
-                dbn, dbe = np.zeros(dtime.size+1),np.zeros(dtime.size+1)
-
-                # Central diff:
-                dbn[1:-1] = (self[s][0,2:]-self[s][0,:-2])/(dtime[1:]+dtime[:-1])
-                dbe[1:-1] = (self[s][1,2:]-self[s][1,:-2])/(dtime[1:]+dtime[:-1])
-                # Forward diff:
-                dbn[0]=(-self[s][0,2]+4*self[s][0,1]-3*self[s][0,0])/(dtime[1]+dtime[0])
-                dbe[0]=(-self[s][1,2]+4*self[s][1,1]-3*self[s][1,0])/(dtime[1]+dtime[0])
-                # Backward diff:
-                dbn[-1]=(3*self[s][0,-1]-4*self[s][0,-2]+self[s][0,-3])/(dtime[-1]+dtime[-2])
-                dbe[-1]=(3*self[s][1,-1]-4*self[s][1,-2]+self[s][1,-3])/(dtime[-1]+dtime[-2])
-                
-                # Create |dB/dt|_h:
-                if s+'H' in stats:
-                    self[s+'_dH'] = np.sqrt(dbn**2 + dbe**2)
-                    
         # Return true on success:
         return True
 
 
+    def _check_vers(self):
+        '''
+        Warn if the file format revision is unrecognized, as the default
+        variable offsets used to read it may be wrong.
+        '''
+
+        if self.vers == 'unrecognized':
+            warnings.warn("Unrecognized file format revision.  "+
+                          "Check validity of file read.")
+
+    def _set_stations(self):
+        '''
+        Expose each station as a dictionary of views into the single
+        data container, `self._buf`.
+        '''
+
+        for i, s in enumerate(self.stations):
+            self[s] = {}  # Start with empty dictionary
+            for j, x in enumerate(['bx','by','bz','bx_geo', 'by_geo','bz_geo']):
+                self[s][x] = self._buf[i, j]
+
+    def _save_cache(self, cachefile):
+        '''
+        Save the parsed data container, times, stations, and file revision
+        to a numpy ".npz" file, *cachefile*.  Failure to write the cache
+        (e.g., a read-only directory) only warns, as the data are loaded.
+        '''
+
+        try:
+            np.savez(cachefile, buf=self._buf, time=self['time'],
+                     stations=np.array(self.stations),
+                     vers=np.array(self.vers))
+        except OSError as err:
+            warnings.warn("Could not write cache file {}: {}".format(
+                cachefile, err))
+
+    def _read_cache(self, cachefile):
+        '''
+        Load data saved by `_save_cache` from *cachefile* in place of
+        reading the original supermag file.
+        '''
+
+        with np.load(cachefile) as cache:
+            self.vers     = cache['vers'].item()
+            self.stations = cache['stations'].tolist()
+            self._buf     = cache['buf']
+            times         = cache['time']
+
+        # Cached data are only as valid as the original read:
+        self._check_vers()
+
+        self.nstats = len(self.stations)
+        self['time'] = times
+        self._set_stations()
+
     def calc_btotal(self):
         '''
         Calculate the magnitude of the perturbation for each magnetometer.
         Save as self['station name']['b'].
         '''
 
-        # Loop through each magnetometer in the object.
-        # Skip the time array.
-        for mag in self.keys():
-            if mag=='time': continue
-            # Total perturbation is just the pythagorean sum!
-            self[mag]['b'] = np.sqrt(
-                self[mag]['bx']**2+
-                self[mag]['by']**2+
-                self[mag]['bz']**2)
+        # Total perturbation is just the pythagorean sum!
+        # Compute it for all magnetometers at once.
+        btotal = np.linalg.norm(self._buf[:, :3], axis=1)
+
+        # Give each magnetometer a view of its own magnitude:
+        for i, mag in enumerate(self.stations):
+            self[mag]['b'] = btotal[i]
+
+        return True
+
+    def calc_h(self):
+        '''
+        Calculate the magnitude of the horizontal perturbation for each
+        magnetometer (following Pulkkinen et al 2013, NON STANDARD!!!).
+        Save as self['station name']['h'].
+        '''
+
+        # Horizontal field magnitude for all magnetometers at once:
+        bh = np.hypot(self._buf[:, 0], self._buf[:, 1])
+
+        # Give each magnetometer a view of its own magnitude:
+        for i, mag in enumerate(self.stations):
+            self[mag]['h'] = bh[i]
+
+        return True
+
+    def calc_dbdt(self):
+        '''
+        Calculate the magnitude of the time derivative of the horizontal
+        perturbation, |dB/dt|_h, for each magnetometer using central
+        differences (one-sided at the end points).
+        Save as self['station name']['dbdt'] in nT/s.  Requires at least
+        three records; raises ValueError otherwise.
+        '''
+
+        if self['time'].size < 3:
+            raise ValueError("calc_dbdt requires at least three records; "
+                             "{} has {}".format(
+                                 getattr(self.filename, 'name', self.filename),
+                                 self['time'].size))
+
+        # Get time step in seconds:
+        dtime = np.diff(self['time']) / np.timedelta64(1, 's')
+        den   = dtime[1:]+dtime[:-1]
+
+        # Get dB_n/dt and dB_e/dt for all magnetometers at once:
+        bh  = self._buf[:, :2]
+        dbh = np.zeros(bh.shape)
+
+        # Central diff:
+        dbh[..., 1:-1] = (bh[..., 2:]-bh[..., :-2])/den
+        # Forward diff:
+        dbh[..., 0] = (-bh[..., 2]+4*bh[..., 1]-3*bh[..., 0])/den[0]
+        # Backward diff:
+        dbh[...,-1] = (3*bh[...,-1]-4*bh[...,-2]+bh[...,-3])/den[-1]
+
+        # Create |dB/dt|_h:
+        dh = np.hypot(dbh[:, 0], dbh[:, 1])
+        for i, mag in enumerate(self.stations):
+            self[mag]['dbdt'] = dh[i]
 
         return True
@@ -1,75 +1,139 @@
 #!/usr/bin/env python
 '''
+Unit tests for the supermag package.  From one directory above the
+repository location, run with either unittest or pytest:
 
+    python -m unittest supermag.test_supermag
+    python -m pytest supermag/test_supermag.py
+
+Test methods are independent of each other, so they may also be run in
+parallel (e.g., with pytest-xdist, `pytest -n auto`).
 '''
 
+import io
+import os
+import mmap
+import functools
+import shutil
+import tempfile
+import warnings
 import numpy as np
 import datetime as dt
 import unittest
 
 import supermag
 
-datadir = supermag.install_dir+'data/'
+# Example files used throughout, resolved once:
+DATA_V2 = os.path.join(supermag.install_dir, 'data', 'example_v2.txt')
+DATA_V5 = os.path.join(supermag.install_dir, 'data', 'example_v5.txt')
+DATA_NOVERS = os.path.join(supermag.install_dir, 'data', 'example_novers.txt')
+DATA_INDEX = os.path.join(supermag.install_dir, 'data', 'example_index.txt')
+
+# Example file for each recognized file format revision.  Add an entry
+# here to test another revision.
+VERSION_FILES = {2: DATA_V2, 5: DATA_V5}
+
+# Hint the OS to start reading the example files into the page cache
+# before any tests run (where supported):
+if hasattr(os, 'posix_fadvise'):
+    for fname in VERSION_FILES.values():
+        fd = os.open(fname, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        os.close(fd)
+
+@functools.lru_cache(maxsize=None)
+def _load(fname):
+    '''
+    Parse SuperMag file *fname* once per test session; repeat calls from
+    any test class return the same object, which tests must not modify.
+    The file is handed to the reader as a memory map, which also tests
+    reading from buffers.
+    '''
+    with open(fname, 'rb') as fd, \
+         mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return supermag.SuperMag(mm)
 
 # Define test case classes to group related tests together:
 class TestSuperMag(unittest.TestCase):
+    '''
+    Test reading of SuperMag data files.  Magnetometer values are
+    compared to 6 decimal places rather than exactly so that the readers
+    may use any IEEE-754 conforming parsing method.
+    '''
 
     # First and last times in example files:
     knownTime = [dt.datetime(2001, 1, 1, 0, 0),
                  dt.datetime(2001, 1, 1, 23, 58)]
 
-    # First and last magnetometer values for stations ALE, BOR:
-    knownALE = {'bx':[-8.6,10.7],'by':[5.8,-4.9], 'bz':[-2.6,-5.6]}
-    knownBOR = {'bx':[-2.3, 5.9],'by':[0.6, 1.7], 'bz':[ 2.6,-2.8]}
+    # First (0) and last (1) magnetometer values for selected stations.
+    # Add a row to test another station.
+    known = np.rec.array(
+        [('ALE', -8.6,  5.8, -2.6, 10.7, -4.9, -5.6),
+         ('BOR', -2.3,  0.6,  2.6,  5.9,  1.7, -2.8)],
+        dtype=[('name', 'U3'), ('bx0', 'f8'), ('by0', 'f8'), ('bz0', 'f8'),
+               ('bx1', 'f8'), ('by1', 'f8'), ('bz1', 'f8')])
+
+    @classmethod
+    def setUpClass(cls):
+        '''Parse each example file once for all tests.'''
+        cls.data = {vers: _load(fname) for vers, fname in VERSION_FILES.items()}
+
+    @staticmethod
+    def _endpoints(mag):
+        '''
+        Return first then last bx, by, bz values of station *mag* as a
+        tuple, rounded to 6 decimal places.
+        '''
+        bx, by, bz = mag['bx'], mag['by'], mag['bz']
+        return tuple(round(float(b[i]), 6)
+                     for i in (0, -1) for b in (bx, by, bz))
+
+    def _check_known(self, data):
+        '''Compare stations in *data* against known endpoint values.'''
+        for row in self.known:
+            self.assertSequenceEqual(self._endpoints(data[row.name]),
+                                     row.item()[1:])
     
-    def testV2(self):
-        ''' Test the Version2 file format '''
-        data = supermag.SuperMag(datadir+'example_v2.txt')
+    def testVersions(self):
+        ''' Test each recognized file format revision '''
+        for vers, data in self.data.items():
+            with self.subTest(vers=vers):
+                # Test file version detection:
+                self.assertEqual(data.vers, vers)
 
-        # Test file version detection:
-        self.assertEqual(data.vers, 2)
-        
-        # Test first and last time entries:
-        self.assertEqual(data['time'][0],  self.knownTime[0] )
-        self.assertEqual(data['time'][-1], self.knownTime[-1])
+                # Test that 'time' leads the station keys:
+                self.assertEqual(list(data), ['time']+data.stations)
 
-        # Test against known magnetic field values:
-        for x in ['bx','by','bz']:
-            # Station ALE:
-            self.assertEqual(data['ALE'][x][ 0], self.knownALE[x][ 0])
-            self.assertEqual(data['ALE'][x][-1], self.knownALE[x][-1])
-            # Station BOR:
-            self.assertEqual(data['BOR'][x][ 0], self.knownBOR[x][ 0])
-            self.assertEqual(data['BOR'][x][-1], self.knownBOR[x][-1])
-                             
-    def testV5(self):
-        ''' Test the Version2 file format '''
-        data = supermag.SuperMag(datadir+'example_v5.txt')
+                # Test first and last time entries:
+                self.assertEqual(data['time'][0],  self.knownTime[0] )
+                self.assertEqual(data['time'][-1], self.knownTime[-1])
 
-        # Test file version detection:
-        self.assertEqual(data.vers, 5)
-        
-        # Test first and last time entries:
-        self.assertEqual(data['time'][0],  self.knownTime[0] )
-        self.assertEqual(data['time'][-1], self.knownTime[-1])
-        
-        # Test against known magnetic field values:
-        for x in ['bx','by','bz']:
-            # Station ALE:
-            self.assertEqual(data['ALE'][x][ 0], self.knownALE[x][ 0])
-            self.assertEqual(data['ALE'][x][-1], self.knownALE[x][-1])
-            # Station BOR:
-            self.assertEqual(data['BOR'][x][ 0], self.knownBOR[x][ 0])
-            self.assertEqual(data['BOR'][x][-1], self.knownBOR[x][-1])
+                # Test against known magnetic field values:
+                self._check_known(data)
 
+    def testFormatsAgree(self):
+        '''
+        Test that every file revision gives the same times and field
+        values as revision 5 across entire files, not just the endpoints.
+        The example files all hold the same underlying data.
+        '''
+        ref = self.data[5]
+        for vers, data in self.data.items():
+            if data is ref: continue
+            with self.subTest(vers=vers):
+                self.assertEqual(data.stations, ref.stations)
+                np.testing.assert_array_equal(data['time'], ref['time'])
+                for s in ref.stations:
+                    mag, refmag = data[s], ref[s]
+                    for x in ('bx','by','bz'):
+                        np.testing.assert_array_equal(mag[x], refmag[x])
 
     def testUnrec(self):
         '''Test that unrecognized version number still works and warns.'''
 
-        # Check that we issue warning:
-        self.assertWarns(Warning, supermag.SuperMag, datadir+'example_novers.txt')
-
-        data = supermag.SuperMag(datadir+'example_novers.txt')
+        # Check that we issue warning; keep the object for further checks:
+        with self.assertWarns(Warning):
+            data = supermag.SuperMag(DATA_NOVERS)
 
         # Test file version detection:
         self.assertEqual(data.vers, 'unrecognized')
@@ -79,14 +143,241 @@ class TestSuperMag(unittest.TestCase):
         self.assertEqual(data['time'][-1], self.knownTime[-1])
         
         # Test against known magnetic field values:
-        for x in ['bx','by','bz']:
-            # Station ALE:
-            self.assertEqual(data['ALE'][x][ 0], self.knownALE[x][ 0])
-            self.assertEqual(data['ALE'][x][-1], self.knownALE[x][-1])
-            # Station BOR:
-            self.assertEqual(data['BOR'][x][ 0], self.knownBOR[x][ 0])
-            self.assertEqual(data['BOR'][x][-1], self.knownBOR[x][-1])
+        self._check_known(data)
+
+        # Reading back from a cache must warn, too:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'example_novers.txt')
+            shutil.copy(DATA_NOVERS, fname)
+            for read in ('parsed', 'cached'):
+                with self.subTest(read=read):
+                    with self.assertWarnsRegex(Warning, 'Unrecognized'):
+                        data = supermag.SuperMag(fname, cache=True)
+                    self.assertEqual(data.vers, 'unrecognized')
+
+
+    def testNoRecords(self):
+        '''Test that a file with a full header but no data records loads.'''
+
+        # Keep everything up to, but not including, the first record:
+        with open(DATA_V5, 'r') as f:
+            text = f.read()
+        header = text[:text.index('\n2001')+1]
+
+        data = supermag.SuperMag(io.StringIO(header))
+
+        self.assertEqual(data.vers, 5)
+        self.assertEqual(data['time'].size, 0)
+        for s in data.stations:
+            self.assertEqual(data[s]['bx'].size, 0)
+
+    def testBadHeader(self):
+        '''Test that files missing header markers raise ValueError.'''
+
+        with open(DATA_V5, 'r') as f:
+            text = f.read()
+
+        # Remove the station selection, then everything from the
+        # end-of-header marker on:
+        cases = {'Selected'  : text.replace('Selected', 'Chosen'),
+                 'Parameters': text[:text.index('Parameters')]}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'bad.txt')
+            for marker, bad in cases.items():
+                with self.subTest(marker=marker):
+                    with open(fname, 'w') as f:
+                        f.write(bad)
+                    with self.assertRaisesRegex(ValueError, marker) as err:
+                        supermag.SuperMag(fname)
+                    self.assertIn(fname, str(err.exception))
+
+    def testCache(self):
+        '''Test that data loaded from a .npz cache matches the original.'''
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'example_v5.txt')
+            shutil.copy(DATA_V5, fname)
+
+            # First read parses the file and writes the cache:
+            orig = supermag.SuperMag(fname, cache=True)
+            self.assertTrue(os.path.exists(fname+'.npz'))
+
+            # Second read loads from the cache:
+            data = supermag.SuperMag(fname, cache=True)
+
+        self.assertEqual(data.vers, orig.vers)
+        self.assertEqual(data.stations, orig.stations)
+        self.assertEqual(list(data), list(orig))
+        np.testing.assert_array_equal(data['time'], orig['time'])
+        for s in orig.stations:
+            cached, parsed = data[s], orig[s]
+            for x in ('bx','by','bz','lt'):
+                np.testing.assert_array_equal(cached[x], parsed[x])
+
+    def testCacheStale(self):
+        '''Test that a cache older than its source file is ignored.'''
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'example.txt')
+            shutil.copy(DATA_V5, fname)
+            supermag.SuperMag(fname, cache=True)
+
+            # Replace the source with another revision; age the cache:
+            shutil.copy(DATA_V2, fname)
+            mtime = os.path.getmtime(fname) - 60
+            os.utime(fname+'.npz', (mtime, mtime))
+
+            data = supermag.SuperMag(fname, cache=True)
+            self.assertEqual(data.vers, 2)
+
+            # The refreshed cache now matches the new source:
+            self.assertEqual(supermag.SuperMag(fname, cache=True).vers, 2)
+
+    def testCacheUnwritable(self):
+        '''Test that failing to write the cache warns but still loads.'''
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'example_v5.txt')
+            shutil.copy(DATA_V5, fname)
+
+            # A directory in place of the cache file cannot be written,
+            # even with root permissions.  Keep it older than the source:
+            os.mkdir(fname+'.npz')
+            mtime = os.path.getmtime(fname) - 60
+            os.utime(fname+'.npz', (mtime, mtime))
+
+            with self.assertWarnsRegex(Warning, 'cache'):
+                data = supermag.SuperMag(fname, cache=True)
+
+        self.assertEqual(data.vers, 5)
+        self._check_known(data)
+
+    def testCalc(self):
+        '''
+        Test derived values against hand calculations using the first and
+        last few ALE records (one minute apart) of the example file.
+        '''
+        # Read a private copy, as the calc methods add new values:
+        data = supermag.SuperMag(DATA_V5)
+        data.calc_btotal()
+        data.calc_h()
+        data.calc_dbdt()
+        ale = data['ALE']
+
+        # Total and horizontal perturbation at both ends:
+        self.assertAlmostEqual(ale['b'][0],  np.sqrt(8.6**2+5.8**2+2.6**2))
+        self.assertAlmostEqual(ale['b'][-1], np.sqrt(10.7**2+4.9**2+5.6**2))
+        self.assertAlmostEqual(ale['h'][0],  np.hypot(8.6, 5.8))
+        self.assertAlmostEqual(ale['h'][-1], np.hypot(10.7, 4.9))
+
+        # |dB/dt|_h in nT/s: one-sided differences at the end points,
+        # central differences (over 120s) in between:
+        known = {0 : np.hypot(-0.2, -0.3)/120, # -B[2]+4B[1]-3B[0]
+                 1 : np.hypot(-0.2, -0.1)/120,
+                 2 : np.hypot( 1.2,  0.4)/120,
+                 -2: np.hypot(-0.7,  1.2)/120,
+                 -1: np.hypot(-1.7,  4.0)/120} # 3B[-1]-4B[-2]+B[-3]
+        for i, dbdt in known.items():
+            with self.subTest(i=i):
+                self.assertAlmostEqual(ale['dbdt'][i], dbdt)
+
+        # Every station gets its own values:
+        for s in data.stations:
+            for x in ('b', 'h', 'dbdt'):
+                self.assertEqual(data[s][x].shape, data['time'].shape)
+
+    def testCalcShort(self):
+        '''Test that calc_dbdt rejects files with fewer than 3 records.'''
+
+        with open(DATA_V5, 'r') as f:
+            text = f.read()
+
+        # Keep the header plus 0 or 2 records, each starting at a time line:
+        parts = text.split('\n2001')
+        cases = {n: '\n2001'.join(parts[:n+1])+'\n' for n in (0, 2)}
+
+        for nrec, short in cases.items():
+            with self.subTest(nrec=nrec):
+                data = supermag.SuperMag(io.StringIO(short))
+                self.assertEqual(data['time'].size, nrec)
+                with self.assertRaisesRegex(ValueError, 'three records'):
+                    data.calc_dbdt()
+
+class TestIndexFile(unittest.TestCase):
+    '''
+    Test reading of SuperMag index files.
+    '''
+
+    def testRead(self):
+        '''Test variable names, times, and values of the example file.'''
+
+        data = supermag.IndexFile(DATA_INDEX)
+
+        self.assertEqual(sorted(data.keys()), ['SML', 'SMU', 'time'])
+
+        # Test first and last time entries:
+        self.assertEqual(data['time'][0],  dt.datetime(2012, 10,  8,  0,  0))
+        self.assertEqual(data['time'][-1], dt.datetime(2012, 10,  9, 11, 59))
+
+        # Test first and last values:
+        self.assertEqual(data['SML'][0],  -353)
+        self.assertEqual(data['SML'][-1],  -90)
+        self.assertEqual(data['SMU'][0],   107)
+        self.assertEqual(data['SMU'][-1],  158)
+        for v in ('SML', 'SMU'):
+            self.assertEqual(data[v].shape, data['time'].shape)
+
+    def testNoRecords(self):
+        '''Test that a file with a header but no records loads quietly.'''
+
+        # Keep everything up to, but not including, the first record:
+        with open(DATA_INDEX, 'r') as f:
+            text = f.read()
+        header = text[:text.index('\n2012')+1]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'empty_index.txt')
+            with open(fname, 'w') as f:
+                f.write(header)
+            with warnings.catch_warnings():
+                warnings.simplefilter('error')
+                data = supermag.IndexFile(fname)
+
+        self.assertEqual(sorted(data.keys()), ['SML', 'SMU', 'time'])
+        for v in data:
+            self.assertEqual(data[v].size, 0)
+
+    def testBadHeader(self):
+        '''Test that a file missing the '==' separator raises ValueError.'''
+
+        with open(DATA_INDEX, 'r') as f:
+            text = f.read()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'bad_index.txt')
+            with open(fname, 'w') as f:
+                f.write(text.replace('==', ''))
+            with self.assertRaisesRegex(ValueError, '==') as err:
+                supermag.IndexFile(fname)
+            self.assertIn(fname, str(err.exception))
+
+class TestStatInfo(unittest.TestCase):
+    '''
+    Test reading of the station information file.
+    '''
+
+    def testRead(self):
+        '''Test values for a station with a single operator.'''
+
+        son = supermag.read_statinfo()['SON']
+
+        self.assertEqual(son['station-name'], 'Sonmiani')
+        self.assertAlmostEqual(son['geolon'], 66.44)
+        self.assertAlmostEqual(son['geolat'], 25.12)
+        self.assertEqual(son['operator-num'], 1)
+        # No trailing quote or newline on the last field:
+        self.assertEqual(son['operators'], 'INTERMAGNET')
 
-        
 if __name__=='__main__':
     unittest.main()